@@ -3,13 +3,19 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-import time
+from plotly.graph_objects import Figure, Bar, Pie, Funnel
+from plotly.colors import qualitative
+import plotly.io as pio
+from plotly.subplots import make_subplots
+import json
+import inspect
+from bisect import bisect_right
 from datetime import datetime, timedelta
 
 # --- 0. ENSURE DETERMINISM ---
 # This ensures that random noise is reproducible. 
 # If you return to the same slider settings, you get the exact same numbers.
-np.random.seed(42)
+# Each block draws from its own np.random.default_rng(42), so nothing touches global state.
 
 
 # --- 1. PAGE CONFIGURATION ---
@@ -21,27 +27,26 @@ st.set_page_config(
 )
 
 # --- 2. LOADING SCREEN ---
-# Only runs once per session
+# Only runs once per session. The overlay fades itself out in CSS, so Python never blocks
+# and the dashboard renders (and becomes clickable) behind it straight away.
 if 'loaded' not in st.session_state:
-    loader = st.empty()
     loader_html = """
     <style>
-        .stApp { overflow: hidden; }
         #loading-overlay {
             position: fixed; top: 0; left: 0; width: 100vw; height: 100vh;
             background-color: #0e1117; z-index: 9999999;
             display: flex; flex-direction: column; align-items: center; justify-content: center;
+            animation: fadeout 1.5s forwards; pointer-events: none;
         }
         .heartbeat { font-size: 80px; animation: beat 1.5s infinite; filter: drop-shadow(0 0 15px rgba(231, 76, 60, 0.6)); }
         .loading-text { margin-top: 20px; font-size: 20px; color: #e0e0e0; font-family: sans-serif; letter-spacing: 2px; animation: fade 1.5s infinite; }
         @keyframes beat { 0% { transform: scale(1); } 10% { transform: scale(1.1); } 20% { transform: scale(1); } 100% { transform: scale(1); } }
         @keyframes fade { 0%, 100% { opacity: 0.5; } 50% { opacity: 1; } }
+        @keyframes fadeout { 0%, 70% { opacity: 1; } 100% { opacity: 0; visibility: hidden; } }
     </style>
     <div id="loading-overlay"><div class="heartbeat">🩸</div><div class="loading-text">LOADING INVENTORY DATA...</div></div>
     """
-    loader.markdown(loader_html, unsafe_allow_html=True)
-    time.sleep(1.5)
-    loader.empty()
+    st.markdown(loader_html, unsafe_allow_html=True)
     st.session_state['loaded'] = True
 
 # --- 3. STATIC THEME ENGINE (DARK MODE ONLY) ---
@@ -52,9 +57,17 @@ dark_mode = True  # <--- THIS IS THE CRITICAL MISSING LINE
 # Set Global Chart Variables for Plotly
 chart_template = "plotly_dark"
 map_style = "carto-darkmatter"
+# Pie palettes as plain tuples: (Supply, Demand)
+PIE_COLORS = (tuple(qualitative.Prism), tuple(qualitative.Safe))
+# Resolved template object, for figures built with validation off (a bare name isn't expanded then)
+DARK_TEMPLATE = pio.templates[chart_template]
 
-# Apply the CSS to fix the app background and tabs
-st.markdown("""
+# st.plotly_chart serializes through plotly.io.to_json: use the native orjson encoder
+pio.json.config.default_engine = "orjson"
+
+# Static page styles (background, tabs, text, metric cards); the same string is
+# re-emitted each run (Streamlit drops elements a rerun does not redraw)
+GLOBAL_CSS = """
 <style>
     /* 1. BACKGROUND GRADIENT */
     [data-testid="stAppViewContainer"] {
@@ -99,8 +112,202 @@ st.markdown("""
     h1, h2, h3, h4, h5, h6, p, li, span, label, [data-testid="stSidebar"] * { 
         color: #ffffff !important; 
     }
+
+    /* 4. METRIC CARDS (Now with Gradients) */
+    .metric-container {
+        display: grid;
+        grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
+        gap: 15px;
+        margin-bottom: 25px;
+    }
+    .metric-card {
+        /* GRADIENT BACKGROUND: Lighter Top-Left -> Darker Bottom-Right */
+        background: linear-gradient(135deg, #2c3e50 0%, #1e2a36 100%);
+
+        border: 1px solid rgba(255, 255, 255, 0.1);
+        border-radius: 12px;
+        padding: 20px;
+        position: relative;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.3);
+        transition: transform 0.2s, box-shadow 0.2s;
+    }
+    .metric-card:hover {
+        /* On hover, slightly brighten the gradient */
+        background: linear-gradient(135deg, #34495e 0%, #2c3e50 100%);
+        transform: translateY(-5px);
+        border-color: rgba(255, 255, 255, 0.3);
+        box-shadow: 0 10px 20px rgba(0, 0, 0, 0.5);
+    }
+    .metric-title {
+        color: #b0c4de; /* Slightly lighter text for contrast */
+        font-size: 0.85rem;
+        font-weight: 600;
+        text-transform: uppercase;
+        letter-spacing: 0.05em;
+        margin-bottom: 8px;
+    }
+    .metric-value {
+        color: white;
+        font-size: 1.8rem;
+        font-weight: 700;
+        margin-bottom: 5px;
+        text-shadow: 0 2px 4px rgba(0,0,0,0.5); /* Text pops against gradient */
+    }
+    .metric-badge {
+        display: inline-block;
+        padding: 4px 10px;
+        border-radius: 6px;
+        font-size: 0.75rem;
+        font-weight: 600;
+        box-shadow: inset 0 0 5px rgba(0,0,0,0.1); /* Inner shadow for depth */
+    }
+    .card-icon {
+        position: absolute;
+        top: 20px;
+        right: 20px;
+        font-size: 1.5rem;
+        opacity: 0.7;
+        filter: drop-shadow(0 2px 2px rgba(0,0,0,0.5));
+    }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Metric card markup; only the placeholders change between reruns
+METRIC_TPL = """
+<div class="metric-container">
+    <div class="metric-card" style="border-left: 4px solid #3b82f6;">
+        <div class="metric-title">Avg Monthly Inflow</div>
+        <div class="metric-value">{monthly_sup:,}</div>
+        <div class="metric-badge" style="background: rgba(59, 130, 246, 0.2); color: #93c5fd;">
+            ↑ {supply_boost}% Boost
+        </div>
+        <div class="card-icon">🩸</div>
+    </div>
+    <div class="metric-card" style="border-left: 4px solid #f97316;">
+        <div class="metric-title">Avg Monthly Outflow</div>
+        <div class="metric-value">{monthly_dem:,}</div>
+        <div class="metric-badge" style="background: rgba(249, 115, 22, 0.2); color: #fdba74;">
+            ↑ {demand_shock}% Surge
+        </div>
+        <div class="card-icon">🚑</div>
+    </div>
+    <div class="metric-card" style="border-left: 4px solid {net_color};">
+        <div class="metric-title">Net Monthly Flow</div>
+        <div class="metric-value" style="color: {net_color};">{monthly_balance:,}</div>
+        <div class="metric-badge" style="background: {net_bg}; color: {net_color};">
+            {net_label}
+        </div>
+        <div class="card-icon">{net_icon}</div>
+    </div>
+    <div class="metric-card" style="border-left: 4px solid {dos_color};">
+        <div class="metric-title">Est. Days of Supply</div>
+        <div class="metric-value" style="color: {dos_color};">{days_of_supply:.1f} Days</div>
+        <div class="metric-badge" style="background: {dos_bg}; color: {dos_color};">
+            Target: >7 Days
+        </div>
+        <div class="card-icon">{dos_icon}</div>
+    </div>
+</div>
+"""
+
+# Metric card styles. Net flow is indexed by (balance >= 0): (color, background, icon, label)
+NET_STYLES = (
+    ("#f87171", "rgba(248, 113, 113, 0.15)", "📉", "Deficit"),  # Red
+    ("#4ade80", "rgba(74, 222, 128, 0.15)", "📈", "Surplus")    # Green
+)
+
+# Days of supply: bucket by DOS_THRESHOLDS -> (color, background, icon)
+DOS_THRESHOLDS = (7, 14)
+DOS_STYLES = (
+    ("#f87171", "rgba(248, 113, 113, 0.15)", "🚨"),  # Red (Critical), < 7 days
+    ("#fbbf24", "rgba(251, 191, 36, 0.15)", "⚠️"),   # Amber (Warning), < 14 days
+    ("#4ade80", "rgba(74, 222, 128, 0.15)", "✅")    # Green (Healthy)
+)
+
+# Tab 2 priority banner; only colour and message change between reruns
+PRIORITY_TPL = """
+<div style="background: rgba({bg_rgb}, 0.1); border-left: 5px solid {b_color}; padding: 12px 20px; border-radius: 8px; margin-bottom: 30px;">
+    <span style="color: {b_color}; font-weight: bold; font-size: 1.1rem;">⚠️ Inventory Priority:</span> 
+    <span style="color: white; font-size: 1rem;">{msg}</span>
+</div>
+"""
+
+# Tab 2/3 chart styling, read by the cached figure builders in the Tab 2 & 3 section
+BAR_COLORS = {
+    "Supply": "rgba(57, 211, 83, 0.85)",   # Clinical Green
+    "Demand": "rgba(248, 113, 113, 0.85)" # Medical Red
+}
+
+# UI REFINEMENTS (Rounded bars and cleaner text)
+BAR_TRACE_STYLE = dict(
+    marker_line_width=1,
+    marker_line_color="rgba(255,255,255,0.15)",
+    textposition="inside",
+    insidetextanchor="middle",
+    textfont=dict(size=13, color="white"),
+    hovertemplate="<b>%{x}</b><br>%{legendgroup}: %{y:,} units<extra></extra>",
+    marker=dict(cornerradius=6)  # Modern rounded look
+)
+
+# LAYOUT POLISH (Decluttering)
+BAR_LAYOUT = dict(
+    template="plotly_dark",
+    height=480,
+    bargap=0.25,
+    paper_bgcolor="rgba(0,0,0,0)",
+    plot_bgcolor="rgba(0,0,0,0)",
+    margin=dict(l=0, r=0, t=20, b=0),
+    legend=dict(
+        orientation="h",
+        y=1.1,
+        x=0.5,
+        xanchor="center",
+        font=dict(size=13)
+    ),
+    xaxis=dict(
+        title="",
+        tickfont=dict(size=15, family="Arial Black"),
+        showgrid=False
+    ),
+    yaxis=dict(
+        title="Units (Pints)",
+        gridcolor="rgba(255,255,255,0.06)",
+        tickfont=dict(color="rgba(255,255,255,0.6)")
+    )
+)
+
+# Shortage threshold reference line
+BAR_HLINE_STYLE = dict(
+    line_dash="dot",
+    line_color="rgba(255,255,255,0.35)",
+    annotation_text="Avg Demand Threshold",
+    annotation_position="top left",
+    annotation_font_size=12
+)
+
+PIE_LAYOUT = dict(
+    template=DARK_TEMPLATE, paper_bgcolor='rgba(0,0,0,0)', height=400, showlegend=True, 
+    margin=dict(l=0, r=0, t=0, b=0)
+)
+
+# Donut centre label, pre-split around the two dynamic parts (total and Supply/Demand)
+PIE_ANNO_PRE = "<span style='font-size:24px; font-weight:bold;'>"
+PIE_ANNO_MID = "</span><br><span style='font-size:14px; color:#a0a0a0;'>"
+PIE_ANNO_POST = " Total</span>"
+
+# Funnel (left) and ranking (right) share one figure; axis 2 belongs to the ranking
+THROUGHPUT_LAYOUT = dict(
+    template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
+    height=380, showlegend=False, margin=dict(l=20, r=20, t=10, b=10),
+    coloraxis=dict(colorscale="RdYlGn", showscale=False),
+    xaxis=dict(title="Units"), yaxis=dict(title="Stage"),
+    xaxis2=dict(title="Utilization %", range=[60, 100], gridcolor="rgba(255,255,255,0.05)"),
+    yaxis2=dict(autorange="reversed", title="")
+)
+FUNNEL_STAGES = np.array(["Donated", "Screened", "Stocked", "Transfused"], dtype=object)
+
+# Apply the CSS to fix the app background and tabs
+st.markdown(GLOBAL_CSS, unsafe_allow_html=True)
 
 
 # --- 4. DATA LOADING & PREP ---
@@ -108,7 +315,8 @@ st.markdown("""
 def load_data():
     try:
         df = pd.read_csv('blood_sample_size.csv')
-        df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
+        # Export format is M/D/YYYY; naming it skips pandas' per-value format inference
+        df['created_at'] = pd.to_datetime(df['created_at'], format='%m/%d/%Y', errors='coerce')
         df['months_active'] = df['months_since_first_donation'].replace(0, 1)
         df['monthly_rate'] = df['pints_donated'] / df['months_active']
         
@@ -123,7 +331,6 @@ def load_data():
             "Sydney": "New South Wales",
             "Brisbane": "Queensland"
         }
-        df['state_name'] = df['city'].map(city_to_state)
         
         # --- B. GEOLOCATION MAPPING ---
         city_coords = {
@@ -137,29 +344,131 @@ def load_data():
             "Brisbane": (-27.4698, 153.0251)
         }
         
-        df['lat'] = df['city'].map(lambda x: city_coords.get(x, (None, None))[0])
-        df['lon'] = df['city'].map(lambda x: city_coords.get(x, (None, None))[1])
+        # Encode cities once, then gather state/coords by integer code (-1 = unknown city)
+        cat = pd.Categorical(df['city'], categories=list(city_coords))
+        coord_arr = np.array(list(city_coords.values()))
+        state_arr = np.array([city_to_state[c] for c in city_coords], dtype=object)
+        valid = cat.codes >= 0
+        
+        df['lat'] = np.where(valid, coord_arr[cat.codes, 0], np.nan)
+        df['lon'] = np.where(valid, coord_arr[cat.codes, 1], np.nan)
+        # Categorical so every state groupby works on integer codes
+        df['state_name'] = pd.Categorical(np.where(valid, state_arr[cat.codes], None))
         
         df.dropna(subset=['lat', 'lon'], inplace=True)
         
         # Add slight jitter
-        np.random.seed(42) 
-        df['lat'] = df['lat'] + np.random.normal(0, 0.005, len(df))
-        df['lon'] = df['lon'] + np.random.normal(0, 0.005, len(df))
+        rng = np.random.default_rng(42)
+        n = len(df)
+        df['lat'] = df['lat'].to_numpy() + rng.normal(0, 0.005, n)
+        df['lon'] = df['lon'].to_numpy() + rng.normal(0, 0.005, n)
+        
+        # --- C. SLIM DOWN ---
+        # Keep only the columns the dashboard reads, in compact dtypes
+        keep_cols = ['created_at', 'pints_donated', 'city', 'state_name', 'lat', 'lon',
+                     'blood_group', 'months_active', 'monthly_rate']
+        df = df[keep_cols].astype({
+            'pints_donated': 'int32',
+            'lat': 'float32',
+            'lon': 'float32',
+            'monthly_rate': 'float32',
+            'city': 'category',
+            'state_name': 'category',
+            'blood_group': 'category'
+        })
             
         return df
     except FileNotFoundError:
         st.error("File 'blood_sample_size.csv' not found. Please upload it.")
         return pd.DataFrame()
 
+# Boundary file is large and never changes: parse it once per process, not per rerun
+@st.cache_resource
+def load_geojson(path='states_min.geojson'):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Static part of the state map (GeoJSON binding, colour scale, camera, styling).
+# Shared across sessions, so callers copy it before patching per-rerun data in.
+@st.cache_resource
+def build_base_map(states, _aus_geo):
+    active_color = "#D32F2F" if dark_mode else "#FF4B4B"
+    inactive_color = "#7a7a7a" if dark_mode else "#E0E0E0"
+
+    custom_scale = [[0.0, inactive_color], [1.0, active_color]]
+
+    base_data = pd.DataFrame({'state_name': list(states), 'active_flag': 0, 'pints_donated': 0})
+
+    fig = px.choropleth_mapbox(
+        base_data,
+        geojson=_aus_geo,
+        locations='state_name',
+        featureidkey="properties.STATE_NAME", 
+        color='active_flag',
+        color_continuous_scale=custom_scale,
+        range_color=[0, 1],
+        hover_name='state_name',
+        hover_data={'active_flag': False, 'pints_donated': True},
+        mapbox_style=map_style,
+        zoom=2.4,
+        center={"lat": -28, "lon": 133},
+        opacity=0.9
+    )
+    
+    fig.update_traces(
+        marker_line_width=1,
+        marker_line_color="rgba(255,255,255,0.25)" if dark_mode else "rgba(0,0,0,0.2)",
+        showscale=False
+    )
+    
+    fig.update_layout(
+        margin={"r":0,"t":0,"l":0,"b":0},
+        paper_bgcolor='rgba(0,0,0,0)',
+        coloraxis_showscale=False,
+        # IMPORTANT: Enable click selection mode
+        clickmode='event+select'
+    )
+    return fig
+
 # --- IMPORTANT: THIS EXECUTES THE FUNCTION ---
 df = load_data()
 
 # --- 5. LOGIC ENGINE (TUNED VOLATILITY) ---
-def run_simulation(df, months_ahead, shock_pct, boost_pct, waste_pct):
+# One resample over the full dataset: monthly pints with one column per state.
+# Every view (national or filtered) sums columns of this table instead of re-resampling.
+# Rows whose created_at failed to parse (NaT) have no month and are left out here.
+@st.cache_data
+def monthly_by_state(df):
+    return (
+        df.set_index('created_at')
+        .groupby('state_name', observed=True)
+        .resample('MS')['pints_donated'].sum()
+        .unstack('state_name', fill_value=0)
+        .asfreq('MS', fill_value=0)
+    )
+
+# All-time pints per state, straight from the rows (undated rows included), for the map hover
+@st.cache_data
+def state_totals(df):
+    return df.groupby('state_name', observed=True)['pints_donated'].sum()
+
+def state_history(monthly, state_key):
+    # Sum the selected states (all of them when no filter), trimmed to the first/last month
+    # with donations. Unlike resampling the subset itself, this also drops edge months whose
+    # rows all donated 0 pints.
+    supply = monthly[list(state_key)].sum(axis=1) if state_key else monthly.sum(axis=1)
+    active = np.flatnonzero(supply.to_numpy())
+    if active.size:
+        supply = supply.iloc[active[0]:active[-1] + 1]
+    return supply
+
+# History prep is the DataFrame-bound half of the model. It is cached per state filter
+# (`state_key`) and on the monthly table itself (small, cheap to hash), so reloaded data
+# never serves stale history.
+@st.cache_data
+def _prep_history(state_key, monthly):
     # 1. PREPARE HISTORY
-    df['created_at'] = pd.to_datetime(df['created_at'])
-    history = df.set_index('created_at').resample('MS')['pints_donated'].sum().reset_index()
+    history = state_history(monthly, state_key).rename_axis('created_at').reset_index(name='pints_donated')
     
     # 2. DETECT TREND & VOLATILITY
     lookback = 24
@@ -172,71 +481,106 @@ def run_simulation(df, months_ahead, shock_pct, boost_pct, waste_pct):
     
     # Calculate Slope & Volatility
     if len(recent) > 1:
-        slope, intercept = np.polyfit(recent['idx'], recent['pints_donated'], 1)
+        # Closed-form least squares from running sums (no LAPACK call for a 2-param fit)
+        n = len(recent)
+        x = recent['idx'].to_numpy(dtype=float)
+        y = recent['pints_donated'].to_numpy(dtype=float)
+        sx, sy = x.sum(), y.sum()
+        sxx, sxy = (x * x).sum(), (x * y).sum()
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        intercept = (sy - slope * sx) / n
         
         # Calculate how much the data naturally bounces (Standard Deviation)
-        predicted_values = (slope * recent['idx']) + intercept
-        residuals = recent['pints_donated'] - predicted_values
-        volatility = residuals.std() 
+        residuals = y - (slope * x + intercept)
+        volatility = residuals.std(ddof=1)
     else:
         slope = 0
         volatility = 10 
 
-    # 3. FORECAST GENERATION
-    forecast_data = []
-    
     last_actual_supply = history['pints_donated'].iloc[-1] if not history.empty else 1000
-    current_inventory = last_actual_supply 
-    current_date = history['created_at'].iloc[-1] if not history.empty else datetime.now()
-    
-    demand_ratio = 0.95 
+    last_date = history['created_at'].iloc[-1] if not history.empty else datetime.now()
+
+    return slope, volatility, last_actual_supply, last_date
 
+# Historical supply with synthetic demand for the trend chart, cached per state filter and data
+@st.cache_data
+def supply_demand_history(state_key, monthly):
+    supply = state_history(monthly, state_key)
+    rng = np.random.default_rng(42)
+    demand_factor = np.float32(0.85) + np.float32(0.3) * rng.random(len(supply), dtype=np.float32)
+    return pd.DataFrame({
+        'Date': supply.index,
+        'Supply': supply.to_numpy(),
+        'Demand': supply.to_numpy(dtype=np.float32) * demand_factor
+    })
+
+# Supply/demand/inventory propagation for `n_paths` independent paths x `months`.
+# Returns three (n_paths, months) arrays, so Monte-Carlo bands are a mean/percentile away.
+def simulate_paths(last_supply, slope, volatility, months, boost_pct, waste_pct, shock_pct,
+                   demand_ratio=0.95, n_paths=1, seed=42):
     # Seed for consistent "randomness" (so lines don't jitter on every click)
-    np.random.seed(42)
+    rng = np.random.default_rng(seed)
 
-    for m in range(1, months_ahead + 1):
-        # A. PROJECT SUPPLY
-        trend_component = last_actual_supply + (slope * m)
-        
-        # FIX: Dampen the volatility (0.3x) so it doesn't drown out the sliders
-        # This keeps the "shape" but prevents it from hitting zero or masking the boost
-        random_bounce = np.random.normal(0, volatility * 0.3)
-        
-        base_supply = trend_component + random_bounce
-        
-        # Safety clamp (but now less likely to be hit due to dampening)
-        base_supply = max(base_supply, 0)
-        
-        # B. APPLY SLIDERS
-        sim_supply = base_supply * (1 + boost_pct/100) * (1 - waste_pct/100)
-        
-        # Demand follows supply
-        base_demand = base_supply * demand_ratio
-        
-        # Reduced noise for demand as well
-        demand_noise = np.random.normal(0, volatility * 0.15) 
-        sim_demand = (base_demand + demand_noise) * (1 + shock_pct/100)
+    m = np.arange(1, months + 1)
 
-        # C. UPDATE INVENTORY
-        current_inventory += (sim_supply - sim_demand)
-        
-        # D. DATE HANDLING
-        next_date = current_date + pd.DateOffset(months=m)
-        
-        forecast_data.append({
-            "Date": next_date.strftime("%b %Y"),
-            "Inventory": int(current_inventory),
-            "MonthlySupply": int(sim_supply),
-            "MonthlyDemand": int(sim_demand)
-        })
+    # A. PROJECT SUPPLY
+    trend_component = last_supply + (slope * m)
+
+    # FIX: Dampen the volatility (0.3x) so it doesn't drown out the sliders
+    # This keeps the "shape" but prevents it from hitting zero or masking the boost
+    random_bounce = rng.normal(0, volatility * 0.3, (n_paths, months))
+
+    # Safety clamp (but now less likely to be hit due to dampening)
+    base_supply = np.maximum(trend_component + random_bounce, 0)
+
+    # B. APPLY SLIDERS
+    sim_supply = base_supply * (1 + boost_pct/100) * (1 - waste_pct/100)
+
+    # Demand follows supply, with reduced noise as well
+    demand_noise = rng.normal(0, volatility * 0.15, (n_paths, months))
+    sim_demand = (base_supply * demand_ratio + demand_noise) * (1 + shock_pct/100)
+
+    # C. UPDATE INVENTORY (running balance, starting from last month's supply)
+    inventory = last_supply + np.cumsum(sim_supply - sim_demand, axis=1)
 
-    forecast_df = pd.DataFrame(forecast_data)
+    return sim_supply, sim_demand, inventory
+
+# Pure numeric forecast: keyed on the prep tuple plus the slider scalars only
+@st.cache_data
+def run_simulation(prep, months_ahead, shock_pct, boost_pct, waste_pct):
+    slope, volatility, last_actual_supply, current_date = prep
+
+    # 3. FORECAST GENERATION (single path of the ensemble kernel)
+    supply_paths, demand_paths, inventory_paths = simulate_paths(
+        last_actual_supply, slope, volatility, months_ahead, boost_pct, waste_pct, shock_pct
+    )
+    sim_supply, sim_demand, inventory = supply_paths[0], demand_paths[0], inventory_paths[0]
+
+    # D. DATE HANDLING
+    # Periods keep only year/month, so a mid-month fallback date still steps cleanly
+    dates = pd.period_range(pd.Period(current_date, freq='M') + 1, periods=months_ahead, freq='M')
+
+    # Whole units, typed once; averages come straight off the arrays
+    supply_units = sim_supply.astype('int32')
+    demand_units = sim_demand.astype('int32')
+
+    forecast_df = pd.DataFrame({
+        "Date": dates.strftime("%b %Y"),
+        "Inventory": inventory.astype('int32'),
+        "MonthlySupply": supply_units,
+        "MonthlyDemand": demand_units
+    })
     
-    avg_sup = forecast_df['MonthlySupply'].mean() if not forecast_df.empty else 0
-    avg_dem = forecast_df['MonthlyDemand'].mean() if not forecast_df.empty else 0
+    avg_sup = supply_units.mean() if months_ahead > 0 else 0
+    avg_dem = demand_units.mean() if months_ahead > 0 else 0
         
     return forecast_df, avg_sup, avg_dem
 
+# Export bytes only change with the forecast itself
+@st.cache_data
+def forecast_to_csv(forecast_df):
+    return forecast_df.to_csv(index=False).encode('utf-8')
+
 # --- 6. SIDEBAR CONTROLS ---
 with st.sidebar:
     # OPTION A: Robust Emoji Logo
@@ -267,12 +611,12 @@ with st.sidebar:
     # Run simulation with the FULL DataFrame (df)
     # This ensures the CSV export contains the complete organizational data
     if not df.empty:
-        forecast_df, monthly_sup, monthly_dem = run_simulation(df, months_to_predict, demand_shock, supply_boost, wastage_rate)
+        monthly = monthly_by_state(df)
+        forecast_df, monthly_sup, monthly_dem = run_simulation(_prep_history((), monthly), months_to_predict, demand_shock, supply_boost, wastage_rate)
         
         st.markdown("---")
         st.subheader("💾 Export Data")
-        csv = forecast_df.to_csv(index=False).encode('utf-8')
-        st.download_button("📥 Download Forecast", csv, "forecast.csv", "text/csv")
+        st.download_button("📥 Download Forecast", forecast_to_csv(forecast_df), "forecast.csv", "text/csv")
 
 
 # --- 7. MAIN DASHBOARD UI ---
@@ -328,444 +672,397 @@ st.markdown("<br>", unsafe_allow_html=True)
 
 # --- C. TABS (THIS IS THE MISSING PART) ---
 # You must define tab1, tab2, tab3 here so the rest of the code knows what they are.
-tab1, tab2, tab3 = st.tabs(["Overview", "By Blood Type", "Utilization"])
+# Tabs track the selected tab (key="active_tab") so hidden tab content can be skipped.
+# CHECK: Does this Streamlit version support tab state? Older ones render every tab, as before.
+TAB_LABELS = ["Overview", "By Blood Type", "Utilization"]
+if "on_change" in inspect.signature(st.tabs).parameters:
+    tab1, tab2, tab3 = st.tabs(TAB_LABELS, key="active_tab", on_change="rerun")
+    # The state filter isn't drawn while Tab 1 is hidden; re-assigning its value keeps
+    # Streamlit from discarding the selection on those runs
+    if "state_pills" in st.session_state:
+        st.session_state["state_pills"] = st.session_state["state_pills"]
+else:
+    tab1, tab2, tab3 = st.tabs(TAB_LABELS)
 
 # --- TAB 1: OVERVIEW & GEOSPATIAL ENGINE ---
 # --- TAB 1: OVERVIEW & GEOSPATIAL ENGINE ---
 with tab1:
-    # --- 0. HANDLE MAP INTERACTION (Must be at the top) ---
-    # This catches the map click BEFORE the widgets are drawn to avoid the API Exception.
+    # .open is False only for a tracked, unselected tab; None/missing means "render anyway"
+    if getattr(tab1, "open", None) is not False:
+        # --- 0. HANDLE MAP INTERACTION (Must be at the top) ---
+        # This catches the map click BEFORE the widgets are drawn to avoid the API Exception.
     
-    # Check if a map interaction occurred
-    if "aus_map_interaction" in st.session_state:
-        map_data = st.session_state.aus_map_interaction
+        # Check if a map interaction occurred
+        if "aus_map_interaction" in st.session_state:
+            map_data = st.session_state.aus_map_interaction
         
-        # Initialize a history tracker to prevent infinite loops
-        if "last_map_data" not in st.session_state:
-            st.session_state["last_map_data"] = None
+            # Initialize a history tracker to prevent infinite loops
+            if "last_map_data" not in st.session_state:
+                st.session_state["last_map_data"] = None
             
-        # Only process if the map selection has CHANGED since the last run
-        if map_data != st.session_state["last_map_data"]:
+            # Only process if the map selection has CHANGED since the last run
+            if map_data != st.session_state["last_map_data"]:
             
-            # Update history so we don't re-process this click
-            st.session_state["last_map_data"] = map_data
+                # Update history so we don't re-process this click
+                st.session_state["last_map_data"] = map_data
             
-            # Check if there is a valid selection
-            if map_data and "selection" in map_data and map_data["selection"]["points"]:
-                clicked_point = map_data["selection"]["points"][0]
-                clicked_state = clicked_point.get("location") or clicked_point.get("hovertext")
+                # Check if there is a valid selection
+                if map_data and "selection" in map_data and map_data["selection"]["points"]:
+                    clicked_point = map_data["selection"]["points"][0]
+                    clicked_state = clicked_point.get("location") or clicked_point.get("hovertext")
                 
-                if clicked_state:
-                    # Get current active filters
-                    current_pills = st.session_state.get("state_pills", [])
+                    if clicked_state:
+                        # Get current active filters
+                        current_pills = st.session_state.get("state_pills", [])
                     
-                    # TOGGLE LOGIC: Add if missing, Remove if present
-                    if clicked_state in current_pills:
-                        current_pills.remove(clicked_state)
-                    else:
-                        current_pills.append(clicked_state)
+                        # TOGGLE LOGIC: Add if missing, Remove if present
+                        if clicked_state in current_pills:
+                            current_pills.remove(clicked_state)
+                        else:
+                            current_pills.append(clicked_state)
                         
-                    # CRITICAL: Update the widget state BEFORE it is instantiated
-                    st.session_state["state_pills"] = current_pills
+                        # CRITICAL: Update the widget state BEFORE it is instantiated
+                        st.session_state["state_pills"] = current_pills
     
-   # 1. GLOBAL METRICS (Gradient Glass Cards)
-    # Added 'linear-gradient' to the background for a premium 3D look.
+       # 1. GLOBAL METRICS (Gradient Glass Cards)
+        # Added 'linear-gradient' to the background for a premium 3D look.
     
-    # --- Logic for Dynamic Colors & Icons ---
-    if monthly_balance >= 0:
-        net_color = "#4ade80" # Green
-        net_bg = "rgba(74, 222, 128, 0.15)"
-        net_icon = "📈"
-        net_label = "Surplus"
-    else:
-        net_color = "#f87171" # Red
-        net_bg = "rgba(248, 113, 113, 0.15)"
-        net_icon = "📉"
-        net_label = "Deficit"
-
-    if days_of_supply < 7:
-        dos_color = "#f87171" # Red (Critical)
-        dos_bg = "rgba(248, 113, 113, 0.15)"
-        dos_icon = "🚨"
-    elif days_of_supply < 14:
-        dos_color = "#fbbf24" # Amber (Warning)
-        dos_bg = "rgba(251, 191, 36, 0.15)"
-        dos_icon = "⚠️"
-    else:
-        dos_color = "#4ade80" # Green (Healthy)
-        dos_bg = "rgba(74, 222, 128, 0.15)"
-        dos_icon = "✅"
-
-    # --- CSS Styles (Now with Gradients) ---
-    st.markdown("""
-    <style>
-        .metric-container {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-            gap: 15px;
-            margin-bottom: 25px;
-        }
-        .metric-card {
-            /* GRADIENT BACKGROUND: Lighter Top-Left -> Darker Bottom-Right */
-            background: linear-gradient(135deg, #2c3e50 0%, #1e2a36 100%);
-            
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            border-radius: 12px;
-            padding: 20px;
-            position: relative;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.3);
-            transition: transform 0.2s, box-shadow 0.2s;
-        }
-        .metric-card:hover {
-            /* On hover, slightly brighten the gradient */
-            background: linear-gradient(135deg, #34495e 0%, #2c3e50 100%);
-            transform: translateY(-5px);
-            border-color: rgba(255, 255, 255, 0.3);
-            box-shadow: 0 10px 20px rgba(0, 0, 0, 0.5);
-        }
-        .metric-title {
-            color: #b0c4de; /* Slightly lighter text for contrast */
-            font-size: 0.85rem;
-            font-weight: 600;
-            text-transform: uppercase;
-            letter-spacing: 0.05em;
-            margin-bottom: 8px;
-        }
-        .metric-value {
-            color: white;
-            font-size: 1.8rem;
-            font-weight: 700;
-            margin-bottom: 5px;
-            text-shadow: 0 2px 4px rgba(0,0,0,0.5); /* Text pops against gradient */
-        }
-        .metric-badge {
-            display: inline-block;
-            padding: 4px 10px;
-            border-radius: 6px;
-            font-size: 0.75rem;
-            font-weight: 600;
-            box-shadow: inset 0 0 5px rgba(0,0,0,0.1); /* Inner shadow for depth */
-        }
-        .card-icon {
-            position: absolute;
-            top: 20px;
-            right: 20px;
-            font-size: 1.5rem;
-            opacity: 0.7;
-            filter: drop-shadow(0 2px 2px rgba(0,0,0,0.5));
-        }
-    </style>
-    """, unsafe_allow_html=True)
-
-    # --- Generate HTML ---
-    html_cards = f"""
-    <div class="metric-container">
-        <div class="metric-card" style="border-left: 4px solid #3b82f6;">
-            <div class="metric-title">Avg Monthly Inflow</div>
-            <div class="metric-value">{int(monthly_sup):,}</div>
-            <div class="metric-badge" style="background: rgba(59, 130, 246, 0.2); color: #93c5fd;">
-                ↑ {supply_boost}% Boost
-            </div>
-            <div class="card-icon">🩸</div>
-        </div>
-        <div class="metric-card" style="border-left: 4px solid #f97316;">
-            <div class="metric-title">Avg Monthly Outflow</div>
-            <div class="metric-value">{int(monthly_dem):,}</div>
-            <div class="metric-badge" style="background: rgba(249, 115, 22, 0.2); color: #fdba74;">
-                ↑ {demand_shock}% Surge
-            </div>
-            <div class="card-icon">🚑</div>
-        </div>
-        <div class="metric-card" style="border-left: 4px solid {net_color};">
-            <div class="metric-title">Net Monthly Flow</div>
-            <div class="metric-value" style="color: {net_color};">{int(monthly_balance):,}</div>
-            <div class="metric-badge" style="background: {net_bg}; color: {net_color};">
-                {net_label}
-            </div>
-            <div class="card-icon">{net_icon}</div>
-        </div>
-        <div class="metric-card" style="border-left: 4px solid {dos_color};">
-            <div class="metric-title">Est. Days of Supply</div>
-            <div class="metric-value" style="color: {dos_color};">{days_of_supply:.1f} Days</div>
-            <div class="metric-badge" style="background: {dos_bg}; color: {dos_color};">
-                Target: >7 Days
-            </div>
-            <div class="card-icon">{dos_icon}</div>
-        </div>
-    </div>
-    """
+        # --- Logic for Dynamic Colors & Icons ---
+        # Table lookups instead of if/elif chains (see NET_STYLES / DOS_STYLES)
+        net_color, net_bg, net_icon, net_label = NET_STYLES[int(monthly_balance >= 0)]
+        dos_color, dos_bg, dos_icon = DOS_STYLES[bisect_right(DOS_THRESHOLDS, days_of_supply)]
+
+        # --- Generate HTML ---
+        html_cards = METRIC_TPL.format(
+            monthly_sup=int(monthly_sup), supply_boost=supply_boost,
+            monthly_dem=int(monthly_dem), demand_shock=demand_shock,
+            monthly_balance=int(monthly_balance), net_color=net_color, net_bg=net_bg,
+            net_label=net_label, net_icon=net_icon,
+            days_of_supply=days_of_supply, dos_color=dos_color, dos_bg=dos_bg, dos_icon=dos_icon
+        )
     
-    # --- RENDER ---
-    st.markdown(html_cards, unsafe_allow_html=True)
+        # --- RENDER ---
+        st.markdown(html_cards, unsafe_allow_html=True)
 
-   # 2. CLEAN HEADER & FILTER (Selection Pills)
-    # Uses clickable "Pills" instead of a text box. No typing required!
+       # 2. CLEAN HEADER & FILTER (Selection Pills)
+        # Uses clickable "Pills" instead of a text box. No typing required!
     
-    col_title, col_status = st.columns([3, 1])
+        col_title, col_status = st.columns([3, 1])
     
-    with col_title:
-        st.subheader("📍 National Overview")
+        with col_title:
+            st.subheader("📍 National Overview")
         
-    with col_status:
-        # Status indicator
-        count = len(st.session_state.get('state_pills', []))
-        if count == 0:
-             st.markdown("*Viewing: **All Australia***")
-        else:
-             st.markdown(f"*Viewing: **{count} Regions***")
+        with col_status:
+            # Status indicator
+            count = len(st.session_state.get('state_pills', []))
+            if count == 0:
+                 st.markdown("*Viewing: **All Australia***")
+            else:
+                 st.markdown(f"*Viewing: **{count} Regions***")
 
-    # 3. FILTER PANEL (Clickable Chips)
-    with st.expander("🔎 Filter States", expanded=True):
+        # 3. FILTER PANEL (Clickable Chips)
+        with st.expander("🔎 Filter States", expanded=True):
         
-        if 'state_name' in df.columns:
-            all_states = sorted(df['state_name'].dropna().unique())
+            if 'state_name' in df.columns:
+                # state_name is categorical: its categories are the distinct states, no row scan needed
+                all_states = sorted(df['state_name'].cat.categories)
             
-            # CHECK: Does this Streamlit version support st.pills?
-            if hasattr(st, "pills"):
-                # MODERN: Clickable Buttons (Not Writeable!)
-                selected_states = st.pills(
-                    "Click to select states:",
-                    all_states,
-                    selection_mode="multi",
-                    key="state_pills"
-                )
+                # CHECK: Does this Streamlit version support st.pills?
+                if hasattr(st, "pills"):
+                    # MODERN: Clickable Buttons (Not Writeable!)
+                    selected_states = st.pills(
+                        "Click to select states:",
+                        all_states,
+                        selection_mode="multi",
+                        key="state_pills"
+                    )
+                else:
+                    # COMPATIBILITY: Fallback for older Streamlit versions
+                    # We use a clean multiselect but remove the "Type..." text to discourage typing
+                    selected_states = st.multiselect(
+                        "Select States:", 
+                        all_states, 
+                        default=[],
+                        placeholder="Choose states...", # Simple text, no instructions to type
+                        key="state_pills"
+                    )
             else:
-                # COMPATIBILITY: Fallback for older Streamlit versions
-                # We use a clean multiselect but remove the "Type..." text to discourage typing
-                selected_states = st.multiselect(
-                    "Select States:", 
-                    all_states, 
-                    default=[],
-                    placeholder="Choose states...", # Simple text, no instructions to type
-                    key="state_pills"
-                )
-        else:
-            selected_states = []
-
-    # 4. FILTERING LOGIC
-    if selected_states:
-        df_local = df[df['state_name'].isin(selected_states)].copy()
-    else:
-        df_local = df.copy()
+                selected_states = []
 
-    # Re-Run Simulation for this local view
-    local_forecast, _, _ = run_simulation(df_local, months_to_predict, demand_shock, supply_boost, wastage_rate)
-
-  # 4. MAP (Interactive: Click to Select)
-    # Allows users to click on the map to toggle states in the filter.
-
-    # --- A. PREPARE DATA ---
-    state_data = df[['state_name']].dropna().drop_duplicates().copy()
-
-    # Logic: Check if filter is active
-    if selected_states:
-        state_data['active_flag'] = state_data['state_name'].isin(selected_states).astype(int)
-    else:
-        state_data['active_flag'] = 0
+        # 4. FILTERING LOGIC
+        # Only the map needs row-level data; supply history comes from the cached monthly table
+        state_key = tuple(sorted(selected_states or []))
+        map_cols = ['lat', 'lon', 'city', 'pints_donated']
+        if selected_states:
+            map_points = df.loc[df['state_name'].isin(selected_states), map_cols]
+        else:
+            map_points = df[map_cols]
 
-    pints_by_state = df_local.groupby('state_name')['pints_donated'].sum()
-    state_data['pints_donated'] = state_data['state_name'].map(pints_by_state).fillna(0)
+        # Re-Run Simulation for this local view (the national view is the sidebar's forecast)
+        if selected_states:
+            local_prep = _prep_history(state_key, monthly)
+            local_forecast, _, _ = run_simulation(local_prep, months_to_predict, demand_shock, supply_boost, wastage_rate)
+        else:
+            local_forecast = forecast_df
 
-    # --- B. LOAD GEOJSON ---
-    import json
-    import os
+      # 4. MAP (Interactive: Click to Select)
+        # Allows users to click on the map to toggle states in the filter.
 
-    map_file_path = 'states_min.geojson' 
-    aus_geo = None
+        # --- A. PREPARE DATA ---
+        state_data = df[['state_name']].dropna().drop_duplicates().copy()
 
-    if os.path.exists(map_file_path):
-        with open(map_file_path, 'r') as f:
-            aus_geo = json.load(f)
-    else:
-        st.error(f"⚠️ Map file missing! Please ensure '{map_file_path}' is in this folder.")
-
-    # --- C. GENERATE MAP ---
-    if aus_geo:
-        active_color = "#D32F2F" if dark_mode else "#FF4B4B"
-        inactive_color = "#7a7a7a" if dark_mode else "#E0E0E0"
-        dot_color = "#D30000" if not dark_mode else "white"
-
-        custom_scale = [[0.0, inactive_color], [1.0, active_color]]
-
-        fig_map = px.choropleth_mapbox(
-            state_data,
-            geojson=aus_geo,
-            locations='state_name',
-            featureidkey="properties.STATE_NAME", 
-            color='active_flag',
-            color_continuous_scale=custom_scale,
-            range_color=[0, 1],
-            hover_name='state_name',
-            hover_data={'active_flag': False, 'pints_donated': True},
-            mapbox_style=map_style,
-            zoom=2.4,
-            center={"lat": -28, "lon": 133},
-            opacity=0.9
-        )
-        
-        fig_map.update_traces(
-            marker_line_width=1,
-            marker_line_color="rgba(255,255,255,0.25)" if dark_mode else "rgba(0,0,0,0.2)",
-            showscale=False
-        )
-        
-        # Only add dots if selection is active
+        # Logic: Check if filter is active
         if selected_states:
-            fig_map.add_trace(go.Scattermapbox(
-                lat=df_local['lat'],
-                lon=df_local['lon'],
-                mode='markers+text',
-                marker=go.scattermapbox.Marker(size=8, color=dot_color),
-                text=df_local['city'],
-                textfont=dict(size=12, color=dot_color, family="Arial Black"),
-                textposition="top center",
-                showlegend=False,
-                hoverinfo='none'
-            ))
+            state_data['active_flag'] = state_data['state_name'].isin(selected_states).astype(int)
+        else:
+            state_data['active_flag'] = 0
+
+        totals = state_totals(df)
+        if state_key:
+            totals = totals[list(state_key)]
+        counts = totals.reindex(state_data['state_name'], fill_value=0)
+        state_data['pints_donated'] = counts.values
+
+        # --- B. LOAD GEOJSON ---
+        try:
+            aus_geo = load_geojson()
+        except FileNotFoundError:
+            aus_geo = None
+            st.error("⚠️ Map file missing! Please ensure 'states_min.geojson' is in this folder.")
+
+        # --- C. GENERATE MAP ---
+        if aus_geo:
+            dot_color = "#D30000" if not dark_mode else "white"
+
+            # Copy the cached base map, then patch in only what changes per rerun
+            fig_map = go.Figure(build_base_map(tuple(state_data['state_name']), aus_geo))
+            fig_map.data[0].z = state_data['active_flag'].to_numpy()
+            fig_map.data[0].customdata = state_data[['active_flag', 'pints_donated']].to_numpy()
         
-        fig_map.update_layout(
-            margin={"r":0,"t":0,"l":0,"b":0},
-            paper_bgcolor='rgba(0,0,0,0)',
-            coloraxis_showscale=False,
-            # IMPORTANT: Enable click selection mode
-            clickmode='event+select'
-        )
+            # Only add dots if selection is active
+            if selected_states:
+                fig_map.add_trace(go.Scattermapbox(
+                    lat=map_points['lat'],
+                    lon=map_points['lon'],
+                    mode='markers+text',
+                    marker=go.scattermapbox.Marker(size=8, color=dot_color),
+                    text=map_points['city'],
+                    textfont=dict(size=12, color=dot_color, family="Arial Black"),
+                    textposition="top center",
+                    showlegend=False,
+                    hoverinfo='none'
+                ))
         
-        # --- D. RENDER MAP WITH SELECTION EVENT ---
-        # on_select="rerun" makes the app reload when you click the map
-        map_event = st.plotly_chart(
-            fig_map, 
-            use_container_width=True, 
-            on_select="rerun",
-            key="aus_map_interaction" # Unique key to track state
-        )
+            # --- D. RENDER MAP WITH SELECTION EVENT ---
+            # on_select="rerun" makes the app reload when you click the map
+            map_event = st.plotly_chart(
+                fig_map, 
+                use_container_width=True, 
+                on_select="rerun",
+                key="aus_map_interaction" # Unique key to track state
+            )
 
-        # --- E. HANDLE CLICK EVENT ---
-        # If user clicked a state, we update the main filter
-        if map_event and "selection" in map_event and map_event["selection"]["points"]:
+            # --- E. HANDLE CLICK EVENT ---
+            # If user clicked a state, we update the main filter
+            if map_event and "selection" in map_event and map_event["selection"]["points"]:
             
-            # 1. Grab the clicked state name
-            clicked_point = map_event["selection"]["points"][0]
-            clicked_state = clicked_point.get("location") or clicked_point.get("hovertext")
+                # 1. Grab the clicked state name
+                clicked_point = map_event["selection"]["points"][0]
+                clicked_state = clicked_point.get("location") or clicked_point.get("hovertext")
             
-            if clicked_state:
-                # 2. Get current filter list (handle safely)
-                current_pills = st.session_state.get("state_pills", [])
+                if clicked_state:
+                    # 2. Get current filter list (handle safely)
+                    current_pills = st.session_state.get("state_pills", [])
                 
-                # 3. Toggle Logic (If active -> remove. If inactive -> add)
-                if clicked_state in current_pills:
-                    current_pills.remove(clicked_state)
-                else:
-                    current_pills.append(clicked_state)
+                    # 3. Toggle Logic (If active -> remove. If inactive -> add)
+                    if clicked_state in current_pills:
+                        current_pills.remove(clicked_state)
+                    else:
+                        current_pills.append(clicked_state)
                 
-                # 4. Push update to Session State & Rerun
-                st.session_state["state_pills"] = current_pills
-                st.rerun()
+                    # 4. Push update to Session State & Rerun
+                    st.session_state["state_pills"] = current_pills
+                    st.rerun()
 
-    else:
-        st.warning("Showing basic map (GeoJSON file not found).")
-        fig_dots = px.scatter_mapbox(df_local, lat="lat", lon="lon", size="pints_donated", zoom=2.4)
-        st.plotly_chart(fig_dots, use_container_width=True)
+        else:
+            st.warning("Showing basic map (GeoJSON file not found).")
+            fig_dots = px.scatter_mapbox(map_points, lat="lat", lon="lon", size="pints_donated", zoom=2.4)
+            st.plotly_chart(fig_dots, use_container_width=True)
 
-  # 5. CLEAN & FRIENDLY SUPPLY VS DEMAND CHART
-    st.markdown("---")
+      # 5. CLEAN & FRIENDLY SUPPLY VS DEMAND CHART
+        st.markdown("---")
     
-    st.subheader(f"📈 {'National Inventory Trends' if not selected_states else 'Local Inventory Trends'}")
-    st.caption("Historical performance compared against future predicted requirements.")
+        st.subheader(f"📈 {'National Inventory Trends' if not selected_states else 'Local Inventory Trends'}")
+        st.caption("Historical performance compared against future predicted requirements.")
     
-    # 1. Prepare Data
-    hist_supply = df_local.set_index('created_at').resample('MS')['pints_donated'].sum().reset_index()
-    hist_supply.columns = ['Date', 'Supply']
-    np.random.seed(42)
-    hist_supply['Demand'] = hist_supply['Supply'] * np.random.uniform(0.85, 1.15, len(hist_supply))
+        # 1. Prepare Data
+        hist_supply = supply_demand_history(state_key, monthly)
     
-    forecast_plot = local_forecast.copy()
-    forecast_plot['Date'] = pd.to_datetime(forecast_plot['Date'], format="%b %Y")
+        forecast_plot = local_forecast.copy()
+        forecast_plot['Date'] = pd.to_datetime(forecast_plot['Date'], format="%b %Y")
     
-    fig_sd = go.Figure()
-
-    # --- THE CLEAN FIX: USE AREA FILLS FOR CLARITY ---
-    # Supply History (Blue Fill)
-    fig_sd.add_trace(go.Scatter(
-        x=hist_supply['Date'], y=hist_supply['Supply'], 
-        mode='lines', name='Supply (Donations)', 
-        fill='tozeroy', fillcolor='rgba(54, 162, 235, 0.1)',
-        line=dict(color='#36a2eb', width=3),
-        legendgroup="Sup"
-    ))
+        fig_sd = go.Figure()
+
+        # --- THE CLEAN FIX: USE AREA FILLS FOR CLARITY ---
+        # Supply History (Blue Fill)
+        fig_sd.add_trace(go.Scatter(
+            x=hist_supply['Date'], y=hist_supply['Supply'], 
+            mode='lines', name='Supply (Donations)', 
+            fill='tozeroy', fillcolor='rgba(54, 162, 235, 0.1)',
+            line=dict(color='#36a2eb', width=3),
+            legendgroup="Sup"
+        ))
     
-    # Demand History (Red Fill)
-    fig_sd.add_trace(go.Scatter(
-        x=hist_supply['Date'], y=hist_supply['Demand'], 
-        mode='lines', name='Demand (Usage)', 
-        fill='tozeroy', fillcolor='rgba(255, 99, 132, 0.1)',
-        line=dict(color='#ff6384', width=3),
-        legendgroup="Dem"
-    ))
-
-    # --- FORECAST LINES (Dashed & No Fill to look "lighter") ---
-    fig_sd.add_trace(go.Scatter(
-        x=forecast_plot['Date'], y=forecast_plot['MonthlySupply'], 
-        mode='lines+markers', name='Supply Forecast', 
-        line=dict(color='#36a2eb', width=2, dash='dot'),
-        marker=dict(size=4, symbol='circle'),
-        legendgroup="Sup", showlegend=False
-    ))
+        # Demand History (Red Fill)
+        fig_sd.add_trace(go.Scatter(
+            x=hist_supply['Date'], y=hist_supply['Demand'], 
+            mode='lines', name='Demand (Usage)', 
+            fill='tozeroy', fillcolor='rgba(255, 99, 132, 0.1)',
+            line=dict(color='#ff6384', width=3),
+            legendgroup="Dem"
+        ))
+
+        # --- FORECAST LINES (Dashed & No Fill to look "lighter") ---
+        fig_sd.add_trace(go.Scatter(
+            x=forecast_plot['Date'], y=forecast_plot['MonthlySupply'], 
+            mode='lines+markers', name='Supply Forecast', 
+            line=dict(color='#36a2eb', width=2, dash='dot'),
+            marker=dict(size=4, symbol='circle'),
+            legendgroup="Sup", showlegend=False
+        ))
     
-    fig_sd.add_trace(go.Scatter(
-        x=forecast_plot['Date'], y=forecast_plot['MonthlyDemand'], 
-        mode='lines+markers', name='Demand Forecast', 
-        line=dict(color='#ff6384', width=2, dash='dot'),
-        marker=dict(size=4, symbol='circle'),
-        legendgroup="Dem", showlegend=False
-    ))
-
-    # --- MINIMALIST LAYOUT ---
-    # Shading the Forecast Zone (Lighter)
-    fig_sd.add_vrect(
-        x0=forecast_plot['Date'].min(), x1=forecast_plot['Date'].max(),
-        fillcolor="rgba(255, 255, 255, 0.03)", layer="below", line_width=0
-    )
+        fig_sd.add_trace(go.Scatter(
+            x=forecast_plot['Date'], y=forecast_plot['MonthlyDemand'], 
+            mode='lines+markers', name='Demand Forecast', 
+            line=dict(color='#ff6384', width=2, dash='dot'),
+            marker=dict(size=4, symbol='circle'),
+            legendgroup="Dem", showlegend=False
+        ))
+
+        # --- MINIMALIST LAYOUT ---
+        # Shading the Forecast Zone (Lighter)
+        fig_sd.add_vrect(
+            x0=forecast_plot['Date'].min(), x1=forecast_plot['Date'].max(),
+            fillcolor="rgba(255, 255, 255, 0.03)", layer="below", line_width=0
+        )
 
-    fig_sd.update_layout(
-        template="plotly_dark", 
-        paper_bgcolor='rgba(0,0,0,0)', 
-        plot_bgcolor='rgba(0,0,0,0)', 
-        height=400, 
-        hovermode="x unified",
-        legend=dict(orientation="h", y=1.1, x=0.5, xanchor='center'),
-        xaxis=dict(
-            showgrid=False, 
-            tickfont=dict(color="rgba(255,255,255,0.5)"),
-            range=[hist_supply['Date'].min(), forecast_plot['Date'].max()]
-        ),
-        yaxis=dict(
-            title="Pints of Blood", 
-            gridcolor="rgba(255,255,255,0.05)",
-            tickfont=dict(color="rgba(255,255,255,0.5)")
-        ),
-        margin=dict(l=0, r=20, t=20, b=0)
-    )
+        fig_sd.update_layout(
+            template="plotly_dark", 
+            paper_bgcolor='rgba(0,0,0,0)', 
+            plot_bgcolor='rgba(0,0,0,0)', 
+            height=400, 
+            hovermode="x unified",
+            legend=dict(orientation="h", y=1.1, x=0.5, xanchor='center'),
+            xaxis=dict(
+                showgrid=False, 
+                tickfont=dict(color="rgba(255,255,255,0.5)"),
+                range=[hist_supply['Date'].min(), forecast_plot['Date'].max()]
+            ),
+            yaxis=dict(
+                title="Pints of Blood", 
+                gridcolor="rgba(255,255,255,0.05)",
+                tickfont=dict(color="rgba(255,255,255,0.5)")
+            ),
+            margin=dict(l=0, r=20, t=20, b=0)
+        )
     
-    st.plotly_chart(fig_sd, use_container_width=True)
+        st.plotly_chart(fig_sd, use_container_width=True)
 
 # --- TAB 2 & 3 (Preserve your existing code if you have it) ---
-with tab2:
+# Per-type Supply/Demand rows with coverage, cached on the (small) unit tuples
+@st.cache_data(max_entries=64)
+def build_df_bar(types, sup_units, dem_units):
+    t_sup = np.array(sup_units)
+    t_dem = np.array(dem_units)
+    coverage = np.where(t_dem > 0, t_sup / np.where(t_dem > 0, t_dem, 1), 1.0)
+    
+    # Compact dtypes: unit counts fit int32, labels become category codes
+    n = len(types)
+    return pd.DataFrame({
+        "Type": pd.Categorical(types * 2, categories=types),
+        "Category": pd.Categorical(["Supply"] * n + ["Demand"] * n, categories=["Supply", "Demand"]),
+        "Units": np.concatenate([t_sup, t_dem]).astype(np.int32),
+        "Coverage": np.concatenate([coverage, coverage])
+    })
+
+# Figure builders: cached on plain tuples/scalars, so a rerun with unchanged inputs reuses
+# the same go.Figure. cache_resource hands back the object itself (no copy); nothing
+# mutates these figures after they are built.
+@st.cache_resource(max_entries=32)
+def build_bar(types, sup_units, dem_units):
+    # 1. GENERATE THE BASE CHART: one go.Bar per category, no DataFrame/px reshaping
+    fig = Figure([
+        Bar(name=name, legendgroup=name, x=types, y=units,
+            marker=dict(color=BAR_COLORS[name]), texttemplate="%{y}")
+        for name, units in (("Supply", sup_units), ("Demand", dem_units))
+    ])
+
+    # 2. STYLE, LAYOUT & REFERENCE LINE (Shortage Threshold)
+    fig.update_traces(**BAR_TRACE_STYLE)
+    fig.update_layout(barmode="group", legend_title_text="Category", **BAR_LAYOUT)
+    fig.add_hline(y=np.mean(dem_units), **BAR_HLINE_STYLE)
+    return fig
+
+@st.cache_resource(max_entries=32)
+def build_pie(types, units, is_supply, center_val, pie_mode):
+    # Plain go.Pie: a handful of slices doesn't need plotly.express' DataFrame pipeline.
+    # Layout goes in with the constructor and schema validation is skipped (trusted, static keys).
+    fig = Figure(
+        data=Pie(
+            values=units, labels=types, hole=0.7,
+            marker=dict(colors=PIE_COLORS[0 if is_supply else 1]),
+            hovertemplate="Type=%{label}<br>Units=%{value}<extra></extra>"
+        ),
+        layout=dict(
+            PIE_LAYOUT,
+            annotations=[dict(text=PIE_ANNO_PRE + str(center_val) + PIE_ANNO_MID + pie_mode + PIE_ANNO_POST,
+                         x=0.5, y=0.5, showarrow=False)]
+        ),
+        _validate=False
+    )
+    return fig
+
+@st.cache_resource(max_entries=32)
+def build_throughput(stage_units, states, rank_scores):
+    # Funnel and ranking go out as one figure: a single st.plotly_chart round-trip for Tab 3
+    fig = make_subplots(rows=1, cols=2, column_widths=[0.6, 0.4], horizontal_spacing=0.12)
+
+    # A funnel is much cleaner for showing 'loss' than a waterfall
+    fig.add_trace(Funnel(
+        x=np.array(stage_units, dtype=np.float64), y=FUNNEL_STAGES,
+        marker=dict(color="#3b82f6"),
+        hovertemplate="Units=%{x}<br>Stage=%{y}<extra></extra>"
+    ), row=1, col=1)
+    # numpy arrays go through the orjson engine as whole buffers, not per-element Python objects
+    scores = np.array(rank_scores, dtype=np.float32)
+    fig.add_trace(Bar(
+        x=scores, y=np.array(states, dtype=object), orientation='h',
+        marker=dict(color=scores, coloraxis="coloraxis"),
+        texttemplate="%{x:.1f}",
+        hovertemplate="Efficiency=%{x}<br>State=%{y}<extra></extra>"
+    ), row=1, col=2)
+    fig.update_layout(**THROUGHPUT_LAYOUT)
+    return fig
+
+# Each tab renders in a fragment: a widget inside it (e.g. the pie toggle) reruns only that
+# tab instead of the whole script. Older Streamlit without fragments runs them as plain calls.
+fragment = getattr(st, "fragment", lambda func: func)
+
+@fragment
+def render_blood_types(df, monthly_sup, monthly_dem):
     st.subheader("🧬 Blood Type distribution")
     
     # --- 1. DATA PREPARATION ---
-    supply_dist = df.groupby('blood_group')['pints_donated'].sum() / df['pints_donated'].sum()
-    type_data = []
-    
-    for bg_name, ratio in supply_dist.items():
-        t_sup = int(monthly_sup * ratio)
-        t_dem = int(monthly_dem * ratio) 
-        coverage = t_sup / t_dem if t_dem > 0 else 1.0
-        
-        type_data.append({"Type": bg_name, "Category": "Supply", "Units": t_sup, "Coverage": coverage})
-        type_data.append({"Type": bg_name, "Category": "Demand", "Units": t_dem, "Coverage": coverage})
-    
-    df_bar = pd.DataFrame(type_data)
+    type_counts = df.groupby('blood_group', observed=True)['pints_donated'].sum()
+    ratios = type_counts / type_counts.sum()
+
+    # Plain per-category columns, computed once: feed df_bar, the cached bar and the pie toggle
+    types = tuple(type_counts.index)
+    pie_cache = {
+        "Supply": {"Type": types, "Units": tuple((monthly_sup * ratios).astype(int).tolist())},
+        "Demand": {"Type": types, "Units": tuple((monthly_dem * ratios).astype(int).tolist())}
+    }
+    df_bar = build_df_bar(types, pie_cache["Supply"]["Units"], pie_cache["Demand"]["Units"])
 
     # --- 2. DYNAMIC PRIORITY LOGIC ---
     priority_df = df_bar.sort_values('Coverage', ascending=True)
@@ -780,12 +1077,7 @@ with tab2:
         b_color, bg_rgb = "#fbbf24", "251, 191, 36"
 
     # --- 3. DYNAMIC INSIGHT BANNER ---
-    st.markdown(f"""
-        <div style="background: rgba({bg_rgb}, 0.1); border-left: 5px solid {b_color}; padding: 12px 20px; border-radius: 8px; margin-bottom: 30px;">
-            <span style="color: {b_color}; font-weight: bold; font-size: 1.1rem;">⚠️ Inventory Priority:</span> 
-            <span style="color: white; font-size: 1rem;">{msg}</span>
-        </div>
-    """, unsafe_allow_html=True)
+    st.markdown(PRIORITY_TPL.format(bg_rgb=bg_rgb, b_color=b_color, msg=msg), unsafe_allow_html=True)
 
     # --- 4. IMPROVED BAR CHART UI ---
     c_bar, c_pie = st.columns([1.8, 1.2], gap="large")
@@ -795,69 +1087,7 @@ with tab2:
         st.caption("Detailed Supply vs Demand comparison per blood group")
         st.markdown("<div style='margin-bottom: 25px;'></div>", unsafe_allow_html=True)
         
-        # 1. GENERATE THE BASE CHART
-        fig_bar = px.bar(
-            df_bar,
-            x="Type",
-            y="Units",
-            color="Category",
-            barmode="group",
-            color_discrete_map={
-                "Supply": "rgba(57, 211, 83, 0.85)",   # Clinical Green
-                "Demand": "rgba(248, 113, 113, 0.85)" # Medical Red
-            },
-            text_auto=True
-        )
-
-        # 2. UI REFINEMENTS (Rounded bars and cleaner text)
-        fig_bar.update_traces(
-            marker_line_width=1,
-            marker_line_color="rgba(255,255,255,0.15)",
-            textposition="inside",
-            insidetextanchor="middle",
-            textfont=dict(size=13, color="white"),
-            hovertemplate="<b>%{x}</b><br>%{legendgroup}: %{y:,} units<extra></extra>",
-            marker=dict(cornerradius=6)  # Modern rounded look
-        )
-
-        # 3. LAYOUT POLISH (Decluttering)
-        fig_bar.update_layout(
-            template="plotly_dark",
-            height=480,
-            bargap=0.25,
-            paper_bgcolor="rgba(0,0,0,0)",
-            plot_bgcolor="rgba(0,0,0,0)",
-            margin=dict(l=0, r=0, t=20, b=0),
-            legend=dict(
-                orientation="h",
-                y=1.1,
-                x=0.5,
-                xanchor="center",
-                font=dict(size=13)
-            ),
-            xaxis=dict(
-                title="",
-                tickfont=dict(size=15, family="Arial Black"),
-                showgrid=False
-            ),
-            yaxis=dict(
-                title="Units (Pints)",
-                gridcolor="rgba(255,255,255,0.06)",
-                tickfont=dict(color="rgba(255,255,255,0.6)")
-            )
-        )
-
-        # 4. ADD REFERENCE LINE (Shortage Threshold)
-        avg_demand = df_bar[df_bar["Category"] == "Demand"]["Units"].mean()
-        fig_bar.add_hline(
-            y=avg_demand,
-            line_dash="dot",
-            line_color="rgba(255,255,255,0.35)",
-            annotation_text="Avg Demand Threshold",
-            annotation_position="top left",
-            annotation_font_size=12
-        )
-
+        fig_bar = build_bar(types, pie_cache["Supply"]["Units"], pie_cache["Demand"]["Units"])
         st.plotly_chart(fig_bar, use_container_width=True, config={"displayModeBar": False})
 
     with c_pie:
@@ -865,21 +1095,13 @@ with tab2:
         pie_mode = st.radio("Focus View:", ["Supply", "Demand"], horizontal=True, key="blood_pie_final_clean")
         
         is_supply = pie_mode == "Supply"
-        df_pie = df_bar[df_bar['Category'] == ('Supply' if is_supply else 'Demand')]
         center_val = int(monthly_sup if is_supply else monthly_dem)
         
-        fig_pie = px.pie(df_pie, values='Units', names='Type', hole=0.7,
-                         color_discrete_sequence=px.colors.qualitative.Prism if is_supply else px.colors.qualitative.Safe)
-        
-        fig_pie.update_layout(
-            template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)', height=400, showlegend=True, 
-            margin=dict(l=0, r=0, t=0, b=0),
-            annotations=[dict(text=f"<span style='font-size:24px; font-weight:bold;'>{center_val}</span><br><span style='font-size:14px; color:#a0a0a0;'>{pie_mode} Total</span>", 
-                         x=0.5, y=0.5, showarrow=False)]
-        )
+        fig_pie = build_pie(pie_cache[pie_mode]["Type"], pie_cache[pie_mode]["Units"], is_supply, center_val, pie_mode)
         st.plotly_chart(fig_pie, use_container_width=True)
 
-with tab3:
+@fragment
+def render_utilization(monthly_sup, wastage_rate):
     st.subheader("♻️ Clinical Throughput & Conversion Audit")
     # --- STRATEGIC NOTE ---
     st.info("""
@@ -921,44 +1143,22 @@ with tab3:
     with col_funnel:
         st.markdown("#### 🌪️ Conversion Funnel")
         st.caption("The path of blood units: Every drop is tracked through the pipeline.")
-        
-        funnel_data = pd.DataFrame({
-            "Stage": ["Donated", "Screened", "Stocked", "Transfused"],
-            "Units": [total_intake, screened_units, screened_units - (wasted_units//2), utilized_units]
-        })
-        
-        # A funnel is much cleaner for showing 'loss' than a waterfall
-        fig_funnel = px.funnel(funnel_data, x='Units', y='Stage', color_discrete_sequence=["#3b82f6"])
-        fig_funnel.update_layout(
-            template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
-            height=380, margin=dict(l=20, r=20, t=10, b=10)
-        )
-        st.plotly_chart(fig_funnel, use_container_width=True, config={'displayModeBar': False})
 
     with col_rank:
         st.markdown("#### 🏆 Regional Efficiency Ranking")
         st.caption("Ranked performance of collection centers.")
-        
-        # --- FIXED: Using np.random to avoid NameError ---
-        states = ["NSW", "VIC", "QLD", "WA", "SA", "TAS"]
-        np.random.seed(42)
-        rank_scores = sorted([np.random.uniform(82, 98) - (wastage_rate/2) for _ in range(6)], reverse=True)
-        
-        rank_df = pd.DataFrame({"State": states, "Efficiency": rank_scores})
-        
-        fig_rank = px.bar(
-            rank_df, x="Efficiency", y="State", orientation='h',
-            color="Efficiency", color_continuous_scale="RdYlGn",
-            text_auto='.1f'
-        )
-        fig_rank.update_layout(
-            template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
-            height=380, showlegend=False, coloraxis_showscale=False,
-            margin=dict(l=0, r=20, t=10, b=10),
-            xaxis=dict(title="Utilization %", range=[60, 100], gridcolor="rgba(255,255,255,0.05)"),
-            yaxis=dict(autorange="reversed", title="")
-        )
-        st.plotly_chart(fig_rank, use_container_width=True, config={'displayModeBar': False})
+
+    # --- FIXED: Using np.random to avoid NameError ---
+    states = ["NSW", "VIC", "QLD", "WA", "SA", "TAS"]
+    rng = np.random.default_rng(42)
+    rank_scores = sorted(rng.uniform(82, 98, len(states)) - (wastage_rate/2), reverse=True)
+
+    # Both charts render below their headings as one combined figure
+    fig_throughput = build_throughput(
+        (total_intake, screened_units, screened_units - (wasted_units//2), utilized_units),
+        tuple(states), tuple(rank_scores)
+    )
+    st.plotly_chart(fig_throughput, use_container_width=True, config={'displayModeBar': False})
 
     # --- 4. CLINICAL INTEGRITY AUDIT (The Hard Data) ---
     st.markdown("---")
@@ -973,6 +1173,14 @@ with tab3:
     }
     st.table(pd.DataFrame(audit_data))
 
+with tab2:
+    if getattr(tab2, "open", None) is not False:
+        render_blood_types(df, monthly_sup, monthly_dem)
+
+with tab3:
+    if getattr(tab3, "open", None) is not False:
+        render_utilization(monthly_sup, wastage_rate)
+
 # --- FOOTER ---
 st.markdown("---")
 f1, f2 = st.columns([1, 1])